@@ -9,3 +9,4 @@ Licensed under the MIT license.
 
 from .server import EmbyServer
 from .device import EmbyDevice
+from .shm import NowPlayingTable
@@ -0,0 +1,71 @@
+"""
+pyemby.breaker
+~~~~~~~~~~~~~~~~~~~~
+Circuit breaker for api calls.
+Copyright (c) 2017-2024 John Mihalic <https://github.com/mezz64>
+Licensed under the MIT license.
+"""
+
+import logging
+
+from pyemby.constants import (
+    CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    """ Tracks consecutive failures and fails fast once tripped. """
+    def __init__(self, threshold, on_change=None):
+        """Initialize breaker.
+
+        threshold: consecutive failures before the circuit opens.
+        on_change: called with (old_state, new_state) on every transition.
+        """
+        self._threshold = threshold
+        self._on_change = on_change
+        self._state = CIRCUIT_CLOSED
+        self._failures = 0
+
+    @property
+    def state(self):
+        """ Return current circuit state. """
+        return self._state
+
+    @property
+    def failures(self):
+        """ Return current count of consecutive failures. """
+        return self._failures
+
+    def allow_request(self):
+        """ Return true if requests may be sent. """
+        return self._state == CIRCUIT_CLOSED
+
+    def record_success(self):
+        """ Note a request that reached the server. """
+        self._failures = 0
+        if self._state == CIRCUIT_HALF_OPEN:
+            self._set_state(CIRCUIT_CLOSED)
+
+    def record_failure(self):
+        """ Note a request that could not reach the server. """
+        self._failures += 1
+        if self._state == CIRCUIT_HALF_OPEN:
+            self._set_state(CIRCUIT_OPEN)
+        elif self._state == CIRCUIT_CLOSED and \
+                self._failures >= self._threshold:
+            self._set_state(CIRCUIT_OPEN)
+
+    def half_open(self):
+        """ Allow a health probe to decide the next state. """
+        if self._state == CIRCUIT_OPEN:
+            self._set_state(CIRCUIT_HALF_OPEN)
+
+    def _set_state(self, state):
+        """ Change state and notify listener. """
+        old_state = self._state
+        self._state = state
+        _LOGGER.debug('Circuit state changed from %s to %s after %s failures',
+                      old_state, state, self._failures)
+        if self._on_change is not None:
+            self._on_change(old_state, state)
@@ -12,6 +12,54 @@ __version__ = '{}.{}'.format(MAJOR_VERSION, MINOR_VERSION)
 
 DEFAULT_TIMEOUT = 10
 
+# Timeouts by url path segment, most specific segment wins
+ENDPOINT_TIMEOUTS = {
+    'Sessions': 5,
+    'Playing': 5,
+    'Items': 10,
+}
+
+HEDGE_PERCENTILE = 95
+HEDGE_HISTORY = 100
+HEDGE_MIN_SAMPLES = 20
+
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_PROBE_INTERVAL = 30
+CIRCUIT_PROBE_TIMEOUT = 5
+
+CALLBACK_TIMEOUT = 10
+CALLBACK_BUDGET = 0.05
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+SNAPSHOT_VERSION = 1
+
+ITEM_BATCH_WINDOW = 0.05
+ITEM_BATCH_SIZE = 100
+ITEM_CACHE_SIZE = 1000
+
+# Extra fields requested for item metadata lookups
+ITEM_FIELDS = (
+    'Overview', 'Genres', 'Studios', 'People', 'Tags', 'Taglines',
+    'ProviderIds', 'ExternalUrls', 'Path', 'MediaStreams', 'Chapters',
+    'DateCreated', 'PremiereDate', 'ProductionYear', 'CommunityRating',
+    'OfficialRating', 'CriticRating',
+)
+
+DEFAULT_MAX_IN_FLIGHT = 10
+
+PRIORITY_COMMAND = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BULK = 2
+
+PRIORITY_LANES = {
+    PRIORITY_COMMAND: 'command',
+    PRIORITY_DEFAULT: 'default',
+    PRIORITY_BULK: 'bulk',
+}
+
 DEFAULT_HEADERS = {
     'Content-Type': "application/json",
     'Accept': "application/json",
@@ -24,3 +72,18 @@ STATE_PLAYING = 'Playing'
 STATE_PAUSED = 'Paused'
 STATE_IDLE = 'Idle'
 STATE_OFF = 'Off'
+
+# Device index fields, order matches EmbyServer._index_device keys
+INDEX_FIELDS = ('state', 'user', 'client', 'item_id')
+
+SHM_MAGIC = b'EMBY'
+SHM_LAYOUT_VERSION = 2
+SHM_CAPACITY = 256
+SHM_READ_RETRIES = 1000
+
+SHM_STATE_CODES = {
+    STATE_OFF: 0,
+    STATE_IDLE: 1,
+    STATE_PAUSED: 2,
+    STATE_PLAYING: 3,
+}
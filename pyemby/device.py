@@ -11,7 +11,8 @@ import logging
 import asyncio
 
 from pyemby.constants import (
-    STATE_PAUSED, STATE_PLAYING, STATE_IDLE, STATE_OFF, API_URL)
+    STATE_PAUSED, STATE_PLAYING, STATE_IDLE, STATE_OFF, API_URL,
+    PRIORITY_COMMAND)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -259,7 +260,7 @@ class EmbyDevice(object):
 
         _LOGGER.debug('Playstate URL: %s', url)
 
-        post = await self.server.api_post(url, params)
+        post = await self.server.api_post(url, params, PRIORITY_COMMAND)
         if post is None:
             _LOGGER.debug('Error sending command.')
         else:
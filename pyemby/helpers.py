@@ -6,6 +6,7 @@ Copyright (c) 2017-2021 John Mihalic <https://github.com/mezz64>
 Licensed under the MIT license.
 """
 import collections.abc
+import time
 
 
 def deprecated_name(name):
@@ -62,3 +63,44 @@ def clean_none_dict_values(obj):
                     queue.append(value)
 
     return obj
+
+
+class TimedCoroutine(object):
+    """
+    Wrap a coroutine and record the longest time any single step of it
+    held the event loop, i.e. ran between two suspensions.
+    """
+    def __init__(self, coro):
+        """Initialize wrapper."""
+        self._coro = coro
+        self.max_step = 0.0
+
+    def __await__(self):
+        """Drive the wrapped coroutine one step at a time."""
+        coro = self._coro
+        value = None
+        error = None
+        while True:
+            start = time.monotonic()
+            try:
+                if error is not None:
+                    signal = coro.throw(error)
+                else:
+                    signal = coro.send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                step = time.monotonic() - start
+                if step > self.max_step:
+                    self.max_step = step
+
+            value = None
+            error = None
+            try:
+                value = yield signal
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as err:  # pylint: disable=broad-except
+                # Pass cancellation and errors on to the wrapped coroutine
+                error = err
@@ -0,0 +1,160 @@
+"""
+pyemby.limiter
+~~~~~~~~~~~~~~~~~~~~
+Priority aware rate limiting for api calls.
+Copyright (c) 2017-2024 John Mihalic <https://github.com/mezz64>
+Licensed under the MIT license.
+"""
+
+import logging
+import asyncio
+import collections
+
+from pyemby.constants import PRIORITY_LANES, PRIORITY_COMMAND
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """ Token bucket limiter with priority lanes and an in-flight cap. """
+    def __init__(self, loop, rate=None, burst=1, max_in_flight=None):
+        """Initialize limiter.
+
+        rate: tokens added per second, None for no rate limit.
+        burst: maximum tokens held by the bucket.
+        max_in_flight: maximum concurrent requests, None for no limit.
+            One slot is held back for the command lane, so other lanes
+            can never fill every slot.
+        """
+        self._loop = loop
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._max_in_flight = max_in_flight
+
+        self._tokens = float(self._burst)
+        self._last_fill = loop.time()
+        self._in_flight = 0
+        self._wake_handle = None
+
+        # Lower lane number is served first
+        self._waiters = {lane: collections.deque() for lane in PRIORITY_LANES}
+        self._wait_stats = {lane: {'count': 0, 'total': 0.0, 'max': 0.0}
+                            for lane in PRIORITY_LANES}
+
+    @property
+    def in_flight(self):
+        """ Return number of requests currently holding a slot. """
+        return self._in_flight
+
+    @property
+    def queue_wait_stats(self):
+        """ Return queue wait statistics per priority lane. """
+        stats = {}
+        for lane, lane_stats in self._wait_stats.items():
+            stats[PRIORITY_LANES[lane]] = {
+                'count': lane_stats['count'],
+                'total': lane_stats['total'],
+                'max': lane_stats['max'],
+                'average': (lane_stats['total'] / lane_stats['count']
+                            if lane_stats['count'] else 0.0),
+                'queued': len(self._waiters[lane]),
+            }
+        return stats
+
+    async def acquire(self, priority):
+        """ Wait for a request slot in the given lane. """
+        start = self._loop.time()
+
+        if not self._has_waiters() and self._try_take(priority):
+            self._record_wait(priority, start)
+            return
+
+        waiter = self._loop.create_future()
+        self._waiters[priority].append(waiter)
+        # Grant now if possible, otherwise make sure a refill wakes us
+        self._wake()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was granted as we were cancelled, hand it back
+                self.release()
+            else:
+                self._waiters[priority].remove(waiter)
+            raise
+
+        self._record_wait(priority, start)
+
+    def release(self):
+        """ Return a request slot. """
+        self._in_flight -= 1
+        self._wake()
+
+    def _has_waiters(self):
+        """ Return true if any lane has queued requests. """
+        return any(self._waiters[lane] for lane in self._waiters)
+
+    def _refill(self):
+        """ Add tokens earned since the last refill. """
+        if self._rate is None:
+            return
+        now = self._loop.time()
+        self._tokens = min(
+            self._burst, self._tokens + (now - self._last_fill) * self._rate)
+        self._last_fill = now
+
+    def _try_take(self, priority):
+        """ Take a token and an in-flight slot if both are available. """
+        if self._max_in_flight is not None:
+            limit = self._max_in_flight
+            if priority != PRIORITY_COMMAND and limit > 1:
+                # Keep a slot free so commands never wait on bulk work
+                limit -= 1
+            if self._in_flight >= limit:
+                return False
+
+        self._refill()
+        if self._rate is not None:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+
+        self._in_flight += 1
+        return True
+
+    def _wake(self):
+        """ Grant slots to queued requests in priority order. """
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+            self._wake_handle = None
+
+        for lane in sorted(self._waiters):
+            queue = self._waiters[lane]
+            while queue:
+                if queue[0].done():
+                    queue.popleft()
+                    continue
+                if not self._try_take(lane):
+                    self._schedule_wake()
+                    return
+                queue.popleft().set_result(None)
+
+    def _schedule_wake(self):
+        """ Retry once the bucket has a token, if that is the limit. """
+        if self._rate is None or self._tokens >= 1:
+            # Waiting on an in-flight slot, release() will wake us
+            return
+        delay = (1 - self._tokens) / self._rate
+        self._wake_handle = self._loop.call_later(delay, self._wake)
+
+    def _record_wait(self, priority, start):
+        """ Update queue wait statistics for a lane. """
+        waited = self._loop.time() - start
+        lane_stats = self._wait_stats[priority]
+        lane_stats['count'] += 1
+        lane_stats['total'] += waited
+        if waited > lane_stats['max']:
+            lane_stats['max'] = waited
+        if waited > 0:
+            _LOGGER.debug('Request in %s lane queued for %.3fs',
+                          PRIORITY_LANES[priority], waited)
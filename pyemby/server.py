@@ -9,16 +9,30 @@ Licensed under the MIT license.
 
 import logging
 import json
+import os
 import uuid
 import asyncio
+import collections
+import time
+from urllib.parse import urlparse
 import aiohttp
 import async_timeout
 
 from pyemby.device import EmbyDevice
 from pyemby.constants import (
     __version__, DEFAULT_TIMEOUT, DEFAULT_HEADERS, API_URL, SOCKET_URL,
-    STATE_PAUSED, STATE_PLAYING, STATE_IDLE)
-from pyemby.helpers import deprecated_name, clean_none_dict_values
+    STATE_PAUSED, STATE_PLAYING, STATE_IDLE, SNAPSHOT_VERSION,
+    ITEM_BATCH_WINDOW, ITEM_BATCH_SIZE, ITEM_CACHE_SIZE, ITEM_FIELDS,
+    DEFAULT_MAX_IN_FLIGHT, PRIORITY_DEFAULT, PRIORITY_BULK,
+    ENDPOINT_TIMEOUTS, HEDGE_PERCENTILE, HEDGE_HISTORY, HEDGE_MIN_SAMPLES,
+    CIRCUIT_CLOSED, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_PROBE_INTERVAL,
+    CIRCUIT_PROBE_TIMEOUT, CALLBACK_TIMEOUT, CALLBACK_BUDGET, SHM_CAPACITY,
+    INDEX_FIELDS)
+from pyemby.breaker import CircuitBreaker
+from pyemby.helpers import (
+    deprecated_name, clean_none_dict_values, TimedCoroutine)
+from pyemby.limiter import RateLimiter
+from pyemby.shm import NowPlayingTable
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -39,7 +53,16 @@ everything else can be done with normal methods
 
 class EmbyServer(object):
     """Emby test."""
-    def __init__(self, host, api_key, port=8096, ssl=False, loop=None):
+    def __init__(self, host, api_key, port=8096, ssl=False, loop=None,
+                 snapshot_path=None, rate_limit=None, rate_burst=1,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, timeouts=None,
+                 hedge_requests=False,
+                 circuit_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 callback_timeout=CALLBACK_TIMEOUT,
+                 callback_budget=CALLBACK_BUDGET, shm_name=None,
+                 shm_capacity=SHM_CAPACITY, device_ttl=None,
+                 max_devices=None, item_fields=ITEM_FIELDS,
+                 item_user_id=None):
         """Initialize base class."""
         self._host = host
         self._api_key = api_key
@@ -49,6 +72,29 @@ class EmbyServer(object):
         self._sessions = None
         self._devices = {}
 
+        # Registry bookkeeping, inactive devices are kept oldest first
+        self._active_devices = set()
+        self._inactive_since = collections.OrderedDict()
+        self._device_ttl = device_ttl
+        self._max_devices = max_devices
+
+        # Secondary indexes: field -> value -> device names
+        self._indexes = {field: {} for field in INDEX_FIELDS}
+        self._index_keys = {}
+
+        # Optional on-disk copy of the device registry for warm starts
+        self._snapshot_path = snapshot_path
+        self._live_sessions = False
+        self._restored = False
+        self._snapshot_loaded = False
+
+        # Batched item metadata lookups
+        self._item_cache = collections.OrderedDict()
+        self._item_requests = {}
+        self._item_flush = None
+        self._item_fields = item_fields
+        self._item_user_id = item_user_id
+
         _LOGGER.debug("pyEmby %s initializing new server at: %s",
                       __version__, host)
 
@@ -82,14 +128,56 @@ class EmbyServer(object):
 
         self.wsck = None
 
+        # Outgoing api request limiting
+        self._limiter = RateLimiter(
+            self._event_loop, rate_limit, rate_burst, max_in_flight)
+
+        # Per-endpoint timeouts, keyed by url path segment
+        self._timeouts = ENDPOINT_TIMEOUTS.copy()
+        if timeouts is not None:
+            self._timeouts.update(timeouts)
+
+        # Hedged GET requests
+        self._hedge_requests = hedge_requests
+        self._latencies = collections.deque(maxlen=HEDGE_HISTORY)
+
+        # Fail fast while the server is unreachable
+        self._breaker = CircuitBreaker(
+            circuit_threshold, self._circuit_state_changed)
+        self._probe_task = None
+
         # Callbacks
         self._new_devices_callbacks = []
         self._stale_devices_callbacks = []
+        self._evicted_devices_callbacks = []
         self._update_callbacks = []
+        self._circuit_callbacks = []
+
+        # Session filters, applied before sessions are processed
+        self._filters = None
+        self._own_device_id = str(self._api_id)
+
+        # Callback watchdog
+        self._callback_timeout = callback_timeout
+        self._callback_budget = callback_budget
+        self._callback_timeouts = {}
+        self._callback_stats = {}
+        self._callback_tasks = set()
+
+        # Optional now playing table for other processes
+        self._shm_table = None
+        if shm_name is not None:
+            self._shm_table = NowPlayingTable(
+                shm_name, shm_capacity, create=True)
 
         self._shutdown = False
         self._registered = False
 
+        # Our own loop isn't running yet, so reading here blocks nothing.
+        # On a shared loop the snapshot is read by register().
+        if self._snapshot_path is not None and self._own_loop:
+            self.load_snapshot()
+
     @property
     def unique_id(self):
         """Return unique ID for connection to Emby."""
@@ -111,31 +199,68 @@ class EmbyServer(object):
         """ Return devices dictionary. """
         return self._devices
 
-    def add_new_devices_callback(self, callback):
+    @property
+    def circuit_state(self):
+        """ Return api circuit breaker state. """
+        return self._breaker.state
+
+    @property
+    def callback_stats(self):
+        """ Return execution statistics per registered callback. """
+        return self._callback_stats
+
+    @property
+    def slow_callbacks(self):
+        """ Return callbacks that exceeded their budget or timeout. """
+        return {callback: stats
+                for callback, stats in self._callback_stats.items()
+                if stats['slow'] or stats['timeouts']}
+
+    @property
+    def queue_wait_stats(self):
+        """ Return api request queue wait statistics per priority lane. """
+        return self._limiter.queue_wait_stats
+
+    def add_new_devices_callback(self, callback, timeout=None):
         """Register as callback for when new devices are added. """
         self._new_devices_callbacks.append(callback)
+        self._set_callback_timeout(callback, timeout)
         _LOGGER.debug('Added new devices callback to %s', callback)
 
     def _do_new_devices_callback(self, msg):
         """Call registered callback functions."""
         for callback in self._new_devices_callbacks:
             _LOGGER.debug('Devices callback %s', callback)
-            self._event_loop.call_soon(callback, msg)
+            self._schedule_callback(callback, msg)
 
-    def add_stale_devices_callback(self, callback):
+    def add_stale_devices_callback(self, callback, timeout=None):
         """Register as callback for when stale devices exist. """
         self._stale_devices_callbacks.append(callback)
+        self._set_callback_timeout(callback, timeout)
         _LOGGER.debug('Added stale devices callback to %s', callback)
 
     def _do_stale_devices_callback(self, msg):
         """Call registered callback functions."""
         for callback in self._stale_devices_callbacks:
             _LOGGER.debug('Stale Devices callback %s', callback)
-            self._event_loop.call_soon(callback, msg)
+            self._schedule_callback(callback, msg)
+
+    def add_evicted_devices_callback(self, callback, timeout=None):
+        """Register as callback for when devices are removed. """
+        self._evicted_devices_callbacks.append(callback)
+        self._set_callback_timeout(callback, timeout)
+        _LOGGER.debug('Added evicted devices callback to %s', callback)
+
+    def _do_evicted_devices_callback(self, msg):
+        """Call registered callback functions."""
+        for callback in self._evicted_devices_callbacks:
+            _LOGGER.debug('Evicted Devices callback %s', callback)
+            self._schedule_callback(callback, msg)
 
-    def add_update_callback(self, callback, device):
+    def add_update_callback(self, callback, device, timeout=None):
         """Register as callback for when a matching device changes."""
         self._update_callbacks.append([callback, device])
+        self._set_callback_timeout(callback, timeout)
         _LOGGER.debug('Added update callback to %s on %s', callback, device)
 
     def remove_update_callback(self, callback, device):
@@ -144,6 +269,21 @@ class EmbyServer(object):
             self._update_callbacks.remove([callback, device])
             _LOGGER.debug('Removed update callback %s for %s',
                           callback, device)
+            self._forget_callback(callback)
+
+    def _forget_callback(self, callback):
+        """ Drop watchdog state for a callback that is no longer used. """
+        if any(callback == registered
+               for registered, _ in self._update_callbacks):
+            return
+        for callbacks in (self._new_devices_callbacks,
+                          self._stale_devices_callbacks,
+                          self._evicted_devices_callbacks,
+                          self._circuit_callbacks):
+            if callback in callbacks:
+                return
+        self._callback_timeouts.pop(callback, None)
+        self._callback_stats.pop(callback, None)
 
     def _do_update_callback(self, msg):
         """Call registered callback functions."""
@@ -151,7 +291,137 @@ class EmbyServer(object):
             if device == msg:
                 _LOGGER.debug('Update callback %s for device %s by %s',
                               callback, device, msg)
-                self._event_loop.call_soon(callback, msg)
+                self._schedule_callback(callback, msg)
+
+    def _schedule_callback(self, callback, msg):
+        """ Run callback on the loop, as a task if it is a coroutine. """
+        if asyncio.iscoroutinefunction(callback):
+            # Hold a reference so the task can't be garbage collected
+            task = asyncio.ensure_future(
+                self._run_async_callback(callback, msg),
+                loop=self._event_loop)
+            self._callback_tasks.add(task)
+            task.add_done_callback(self._callback_tasks.discard)
+        else:
+            self._event_loop.call_soon(self._run_callback, callback, msg)
+
+    def _run_callback(self, callback, msg):
+        """ Run plain callback, timing how long it blocks the loop. """
+        start = time.monotonic()
+        try:
+            callback(msg)
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception('Error in callback %s', callback)
+        self._record_callback(callback, time.monotonic() - start)
+
+    async def _run_async_callback(self, callback, msg):
+        """ Run coroutine callback with a timeout, timing each step. """
+        timeout = self._callback_timeouts.get(
+            callback, self._callback_timeout)
+        timed = TimedCoroutine(callback(msg))
+        start = time.monotonic()
+        timed_out = False
+        try:
+            await asyncio.wait_for(timed, timeout)
+        except asyncio.TimeoutError:
+            _LOGGER.warning('Callback %s timed out after %ss',
+                            callback, timeout)
+            timed_out = True
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception('Error in callback %s', callback)
+        self._record_callback(callback, time.monotonic() - start,
+                              timed.max_step, timed_out)
+
+    def _set_callback_timeout(self, callback, timeout):
+        """ Store a per-callback timeout for coroutine callbacks. """
+        if timeout is not None:
+            self._callback_timeouts[callback] = timeout
+
+    def _record_callback(self, callback, elapsed, blocked=None,
+                         timed_out=False):
+        """ Update watchdog statistics for a callback.
+
+        elapsed is the total run time, blocked the longest stretch the
+        callback held the loop (all of it for plain callbacks).
+        """
+        if blocked is None:
+            blocked = elapsed
+
+        stats = self._callback_stats.get(callback)
+        if stats is None:
+            stats = {'calls': 0, 'slow': 0, 'timeouts': 0, 'max': 0.0,
+                     'max_blocked': 0.0}
+            self._callback_stats[callback] = stats
+
+        stats['calls'] += 1
+        if elapsed > stats['max']:
+            stats['max'] = elapsed
+        if blocked > stats['max_blocked']:
+            stats['max_blocked'] = blocked
+        if timed_out:
+            stats['timeouts'] += 1
+        if blocked > self._callback_budget:
+            stats['slow'] += 1
+            _LOGGER.warning('Callback %s blocked the event loop for %.3fs',
+                            callback, blocked)
+
+    def add_circuit_callback(self, callback, timeout=None):
+        """Register as callback for circuit breaker state changes. """
+        self._circuit_callbacks.append(callback)
+        self._set_callback_timeout(callback, timeout)
+        _LOGGER.debug('Added circuit callback to %s', callback)
+
+    def _do_circuit_callback(self, msg):
+        """Call registered callback functions."""
+        for callback in self._circuit_callbacks:
+            _LOGGER.debug('Circuit callback %s', callback)
+            self._schedule_callback(callback, msg)
+
+    def _circuit_state_changed(self, old_state, new_state):
+        """ React to circuit breaker transitions. """
+        if new_state == CIRCUIT_CLOSED:
+            _LOGGER.info('Emby server reachable again, resuming requests.')
+        elif old_state == CIRCUIT_CLOSED:
+            _LOGGER.error('Emby server unreachable, failing requests fast.')
+
+        if new_state != CIRCUIT_CLOSED and self._probe_task is None:
+            self._probe_task = asyncio.ensure_future(
+                self._circuit_probe(), loop=self._event_loop)
+
+        self._do_circuit_callback(new_state)
+
+    async def _circuit_probe(self):
+        """ Probe server health until the circuit closes. """
+        url = '{}/System/Info/Public'.format(self.construct_url(API_URL))
+        try:
+            while not self._shutdown and \
+                    self._breaker.state != CIRCUIT_CLOSED:
+                await asyncio.sleep(CIRCUIT_PROBE_INTERVAL)
+                self._breaker.half_open()
+                _LOGGER.debug('Probing Emby server health.')
+                try:
+                    with async_timeout.timeout(CIRCUIT_PROBE_TIMEOUT):
+                        probe = await self._api_session.get(url)
+                    probe.release()
+                    healthy = probe.status == 200
+                except (aiohttp.ClientError, asyncio.TimeoutError,
+                        ConnectionRefusedError) as err:
+                    _LOGGER.debug('Emby health probe failed: %s', err)
+                    healthy = False
+
+                if healthy:
+                    self._breaker.record_success()
+                else:
+                    self._breaker.record_failure()
+        finally:
+            self._probe_task = None
+
+    def _record_response(self, status):
+        """ Count server errors against the circuit breaker. """
+        if status >= 500:
+            self._breaker.record_failure()
+        else:
+            self._breaker.record_success()
 
     def start(self):
         """Public method for initiating connectivity with the emby server."""
@@ -167,6 +437,25 @@ class EmbyServer(object):
         """Async method for stopping connectivity with the emby server."""
         self._shutdown = True
 
+        if self._probe_task is not None:
+            probe = self._probe_task
+            probe.cancel()
+            await asyncio.gather(probe, return_exceptions=True)
+
+        # Skip ourselves in case a callback is the one stopping us
+        tasks = [task for task in self._callback_tasks
+                 if task is not asyncio.current_task()]
+        if tasks:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        await self.async_save_snapshot()
+
+        if self._shm_table is not None:
+            self._shm_table.close()
+            self._shm_table = None
+
         if self.wsck:
             _LOGGER.info('Closing Emby server websocket.')
             await self.wsck.close()
@@ -191,32 +480,215 @@ class EmbyServer(object):
         else:
             return None
 
+    def load_snapshot(self):
+        """ Restore devices and sessions from the snapshot file.
+
+        Reads the file synchronously, use async_load_snapshot on a
+        running event loop.
+        """
+        if self._snapshot_path is None:
+            return False
+        return self._restore_snapshot(self._read_snapshot())
+
+    async def async_load_snapshot(self):
+        """ Restore devices and sessions, reading the file off the loop. """
+        if self._snapshot_path is None:
+            return False
+        snapshot = await self._event_loop.run_in_executor(
+            None, self._read_snapshot)
+        return self._restore_snapshot(snapshot)
+
+    def _read_snapshot(self):
+        """ Read and decode the snapshot file. """
+        try:
+            with open(self._snapshot_path, 'r') as snap_file:
+                return json.load(snap_file)
+        except FileNotFoundError:
+            _LOGGER.debug('No Emby snapshot found at %s', self._snapshot_path)
+        except (OSError, ValueError) as err:
+            _LOGGER.error('Unable to load Emby snapshot: %s', err)
+        return None
+
+    def _restore_snapshot(self, snapshot):
+        """ Rebuild the device registry from decoded snapshot data. """
+        self._snapshot_loaded = True
+        if snapshot is None:
+            return False
+
+        try:
+            if snapshot.get('version') != SNAPSHOT_VERSION:
+                _LOGGER.debug('Ignoring Emby snapshot with version %s',
+                              snapshot.get('version'))
+                return False
+
+            sessions = snapshot.get('sessions')
+            restored = {}
+            for dev_name, saved in snapshot.get('devices', {}).items():
+                device = EmbyDevice(saved['session'], self)
+                device.set_active(bool(saved.get('active', False)))
+                restored[dev_name] = device
+        except (AttributeError, KeyError, TypeError, ValueError) as err:
+            _LOGGER.error('Ignoring malformed Emby snapshot: %s', err)
+            return False
+
+        self._sessions = sessions
+        now = time.monotonic()
+        for dev_name, device in restored.items():
+            if dev_name in self._devices:
+                # Live data got here first
+                continue
+            self._devices[dev_name] = device
+            if device.is_active:
+                self._active_devices.add(dev_name)
+            else:
+                self._inactive_since[dev_name] = now
+            self._index_device(dev_name)
+
+        _LOGGER.debug('Restored %s Emby devices from snapshot.',
+                      len(restored))
+        # Announce restored devices with the first live update
+        self._restored = bool(restored)
+        return True
+
+    def save_snapshot(self):
+        """ Persist devices and sessions to the snapshot file.
+
+        Writes the file synchronously, use async_save_snapshot on a
+        running event loop.
+        """
+        if self._snapshot_path is None:
+            return False
+        data = self._dump_snapshot()
+        return data is not None and self._write_snapshot(data)
+
+    async def async_save_snapshot(self):
+        """ Persist devices and sessions, writing the file off the loop. """
+        if self._snapshot_path is None:
+            return False
+        data = self._dump_snapshot()
+        if data is None:
+            return False
+        return await self._event_loop.run_in_executor(
+            None, self._write_snapshot, data)
+
+    def _dump_snapshot(self):
+        """ Encode the registry on the loop, before devices change. """
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'sessions': self._sessions,
+            'devices': {
+                dev_name: {'session': device.session_raw,
+                           'active': device.is_active}
+                for dev_name, device in self._devices.items()},
+        }
+        try:
+            return json.dumps(snapshot)
+        except (TypeError, ValueError) as err:
+            _LOGGER.error('Unable to encode Emby snapshot: %s', err)
+            return None
+
+    def _write_snapshot(self, data):
+        """ Write encoded snapshot data to disk. """
+        # Write to a temp file first so a crash never leaves a partial file
+        tmp_path = '{}.tmp'.format(self._snapshot_path)
+        try:
+            with open(tmp_path, 'w') as snap_file:
+                snap_file.write(data)
+            os.replace(tmp_path, self._snapshot_path)
+        except OSError as err:
+            _LOGGER.error('Unable to save Emby snapshot: %s', err)
+            return False
+        return True
+
     async def register(self):
         """Register library device id and get initial device list. """
         url = '{}/Sessions'.format(self.construct_url(API_URL))
         params = {'api_key': self._api_key}
 
+        if self._snapshot_path is not None and not self._snapshot_loaded:
+            await self.async_load_snapshot()
+
+        # Open the websocket while the initial fetch is in flight.
+        socket = asyncio.ensure_future(
+            self._socket_loop(), loop=self._event_loop)
+
         reg = await self.api_request(url, params)
         if reg is None:
             self._registered = False
+            socket.cancel()
+            await asyncio.gather(socket, return_exceptions=True)
+            if self.wsck:
+                await self.wsck.close()
+                self.wsck = None
             _LOGGER.error('Unable to register emby client.')
         else:
             self._registered = True
             _LOGGER.info('Emby client registered!, Id: %s', self.unique_id)
-            self._sessions = clean_none_dict_values(reg)
 
-            # Build initial device list.
-            self.update_device_list(self._sessions)
+            if self._live_sessions:
+                # Websocket beat the fetch, its data is already newer.
+                _LOGGER.debug('Sessions already received from websocket.')
+            else:
+                self._sessions = clean_none_dict_values(
+                    self.filter_sessions(reg))
+
+                # Build initial device list.
+                self.update_device_list(self._sessions)
+
+            await self.async_save_snapshot()
+
+    def endpoint_timeout(self, url):
+        """ Return timeout for url using the most specific path segment. """
+        segments = urlparse(url).path.split('/')
+        for segment in reversed(segments):
+            if segment in self._timeouts:
+                return self._timeouts[segment]
+        return DEFAULT_TIMEOUT
+
+    def _hedge_delay(self):
+        """ Return latency percentile used to trigger a hedge request. """
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1,
+                    int(len(ordered) * HEDGE_PERCENTILE / 100))
+        return ordered[index]
 
-            asyncio.ensure_future(self.socket_connection(), loop=self._event_loop)
+    async def _acquire_slot(self, priority, timeout, url):
+        """ Wait for a limiter slot within the request deadline.
 
-    async def api_post(self, url, params):
+        Returns the time left for the request itself, or None if the
+        deadline passed while queued.
+        """
+        deadline = self._event_loop.time() + timeout
+        try:
+            await asyncio.wait_for(self._limiter.acquire(priority), timeout)
+        except asyncio.TimeoutError:
+            _LOGGER.error('Timed out after %ss waiting to send request to %s',
+                          timeout, url)
+            return None
+        return max(deadline - self._event_loop.time(), 0)
+
+    async def api_post(self, url, params, priority=PRIORITY_DEFAULT,
+                       timeout=None):
         """Make api post request."""
+        if not self._breaker.allow_request():
+            _LOGGER.debug('Circuit %s, not posting to %s',
+                          self._breaker.state, url)
+            return None
+
+        if timeout is None:
+            timeout = self.endpoint_timeout(url)
+
         post = None
+        remaining = await self._acquire_slot(priority, timeout, url)
+        if remaining is None:
+            return None
         try:
-            with async_timeout.timeout(DEFAULT_TIMEOUT):
+            with async_timeout.timeout(remaining):
                 post = await self._api_session.post(
                     url, params=params)
+            self._record_response(post.status)
             if post.status != 204:
                 _LOGGER.error('Error posting Emby data: %s', post.status)
                 return None
@@ -227,20 +699,80 @@ class EmbyServer(object):
         except (aiohttp.ClientError, asyncio.TimeoutError,
                 ConnectionRefusedError) as err:
             _LOGGER.error('Error posting Emby data: %s', err)
+            self._breaker.record_failure()
             return None
+        finally:
+            self._limiter.release()
 
-    async def api_request(self, url, params):
+    async def api_request(self, url, params, priority=PRIORITY_DEFAULT,
+                          timeout=None):
         """Make api fetch request."""
+        if timeout is None:
+            timeout = self.endpoint_timeout(url)
+
+        if self._hedge_requests:
+            return await self._api_request_hedged(
+                url, params, priority, timeout)
+        return await self._api_fetch(url, params, priority, timeout)
+
+    async def _api_request_hedged(self, url, params, priority, timeout):
+        """ Send a second fetch if the first is slower than usual. """
+        delay = self._hedge_delay()
+        first = asyncio.ensure_future(
+            self._api_fetch(url, params, priority, timeout),
+            loop=self._event_loop)
+        if delay is None or delay >= timeout:
+            return await first
+
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return first.result()
+
+            _LOGGER.debug('No response after %.3fs, hedging request to %s',
+                          delay, url)
+            # The hedge only gets what is left of the original deadline
+            pending.add(asyncio.ensure_future(
+                self._api_fetch(url, params, priority, timeout - delay),
+                loop=self._event_loop))
+
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if result is not None:
+                        return result
+            return None
+        finally:
+            # Cancel the losing attempt
+            for task in pending:
+                task.cancel()
+
+    async def _api_fetch(self, url, params, priority, timeout):
+        """ Make a single api fetch attempt. """
+        if not self._breaker.allow_request():
+            _LOGGER.debug('Circuit %s, not fetching %s',
+                          self._breaker.state, url)
+            return None
+
         request = None
+        remaining = await self._acquire_slot(priority, timeout, url)
+        if remaining is None:
+            return None
         try:
-            with async_timeout.timeout(DEFAULT_TIMEOUT):
+            start = self._event_loop.time()
+            with async_timeout.timeout(remaining):
                 request = await self._api_session.get(
                     url, params=params)
+            self._record_response(request.status)
             if request.status != 200:
                 _LOGGER.error('Error fetching Emby data: %s', request.status)
                 return None
 
             request_json = await request.json()
+            self._latencies.append(self._event_loop.time() - start)
             if 'error' in request_json:
                 _LOGGER.error('Error converting Emby data to json: %s: %s',
                               request_json['error']['code'],
@@ -250,7 +782,10 @@ class EmbyServer(object):
         except (aiohttp.ClientError, asyncio.TimeoutError,
                 ConnectionRefusedError) as err:
             _LOGGER.error('Error fetching Emby data: %s', err)
+            self._breaker.record_failure()
             return None
+        finally:
+            self._limiter.release()
 
     async def socket_connection(self):
         """ Open websocket connection. """
@@ -258,6 +793,10 @@ class EmbyServer(object):
             _LOGGER.error('Client not registered, cannot start socket.')
             return
 
+        await self._socket_loop()
+
+    async def _socket_loop(self):
+        """ Maintain websocket connection, reconnecting as needed. """
         url = '{}?DeviceID={}&api_key={}'.format(
             self.construct_url(SOCKET_URL), self._api_id, self._api_key)
 
@@ -313,7 +852,9 @@ class EmbyServer(object):
 
         _LOGGER.debug('New websocket message recieved of type: %s', msgtype)
         if msgtype == 'Sessions':
-            self._sessions = clean_none_dict_values(msgdata)
+            self._live_sessions = True
+            self._sessions = clean_none_dict_values(
+                self.filter_sessions(msgdata))
             # Check for new devices and update as needed.
             self.update_device_list(self._sessions)
         """
@@ -325,6 +866,81 @@ class EmbyServer(object):
         - SessionEnded
         """
 
+    def set_session_filters(self, include_devices=None, exclude_devices=None,
+                            include_clients=None, exclude_clients=None,
+                            include_users=None, exclude_users=None,
+                            remote_control_only=False):
+        """ Limit which sessions become devices.
+
+        Include filters keep only matching sessions, exclude filters drop
+        matching sessions, and an empty include list keeps nothing.
+        Devices are matched by DeviceId, clients by Client and users by
+        UserName or UserId.  Call with no arguments to clear all filters.
+        """
+        def to_set(values):
+            """ Return values as a frozenset, or None if not given. """
+            if values is None:
+                return None
+            if isinstance(values, str):
+                values = [values]
+            return frozenset(values)
+
+        filters = (to_set(include_devices), to_set(exclude_devices),
+                   to_set(include_clients), to_set(exclude_clients),
+                   to_set(include_users), to_set(exclude_users),
+                   remote_control_only)
+        if any(value is not None for value in filters[:-1]) or \
+                remote_control_only:
+            self._filters = filters
+        else:
+            self._filters = None
+        _LOGGER.debug('Session filters set to %s', self._filters)
+
+    def filter_sessions(self, sessions):
+        """ Return sessions passing the configured filters. """
+        if sessions is None:
+            return None
+
+        own_id = self._own_device_id
+        if self._filters is None:
+            return [session for session in sessions
+                    if session.get('DeviceId') != own_id]
+
+        return [session for session in sessions
+                if session.get('DeviceId') != own_id and
+                self._session_allowed(session)]
+
+    def _session_allowed(self, session):
+        """ Check a raw session against the configured filters. """
+        (include_devices, exclude_devices, include_clients, exclude_clients,
+         include_users, exclude_users, remote_control_only) = self._filters
+
+        if remote_control_only and not session.get('SupportsRemoteControl'):
+            return False
+
+        device_id = session.get('DeviceId')
+        if include_devices is not None and device_id not in include_devices:
+            return False
+        if exclude_devices is not None and device_id in exclude_devices:
+            return False
+
+        client = session.get('Client')
+        if include_clients is not None and client not in include_clients:
+            return False
+        if exclude_clients is not None and client in exclude_clients:
+            return False
+
+        if include_users is not None or exclude_users is not None:
+            users = (session.get('UserName'), session.get('UserId'))
+            if include_users is not None and \
+                    not any(user in include_users for user in users):
+                return False
+            if exclude_users is not None and \
+                    any(user in exclude_users for user in users):
+                return False
+
+        return True
+
     def update_device_list(self, sessions):
         """ Update device list. """
         if sessions is None:
@@ -332,9 +948,21 @@ class EmbyServer(object):
             return
 
         new_devices = []
-        active_devices = []
+        active_devices = set()
         dev_update = False
+
+        # Restored devices are announced ahead of any other callback, and
+        # at most one new devices callback goes out per update.
+        announced = False
+        if self._restored:
+            self._restored = False
+            self._do_new_devices_callback(0)
+            announced = True
+
         for device in sessions:
+            if device['DeviceId'] == self._own_device_id:
+                continue
+
             dev_name = '{}.{}'.format(device['DeviceId'], device['Client'])
 
             try:
@@ -344,15 +972,16 @@ class EmbyServer(object):
             except KeyError:
                 pass
 
-            active_devices.append(dev_name)
-            if dev_name not in self._devices and \
-                    device['DeviceId'] != str(self._api_id):
+            active_devices.add(dev_name)
+            if dev_name not in self._devices:
                 _LOGGER.debug('New Emby DeviceID: %s. Adding to device list.',
                               dev_name)
                 new = EmbyDevice(device, self)
                 self._devices[dev_name] = new
+                self._inactive_since.pop(dev_name, None)
+                self._index_device(dev_name)
                 new_devices.append(new)
-            elif device['DeviceId'] != str(self._api_id):
+            else:
                 # Before we send in new data check for changes to state
                 # to decide if we need to fire the update callback
                 if not self._devices[dev_name].is_active:
@@ -364,25 +993,138 @@ class EmbyServer(object):
                     self._devices[dev_name], device)
                 self._devices[dev_name].update_data(device)
                 self._devices[dev_name].set_active(True)
-                if dev_update:
+                self._inactive_since.pop(dev_name, None)
+                self._index_device(dev_name)
+                if dev_update and not announced:
                     self._do_new_devices_callback(0)
-                    dev_update = False
+                    announced = True
+                dev_update = False
                 if do_update:
                     self._do_update_callback(dev_name)
 
+        # Evict before flagging new inactive devices, so nothing removed
+        # here still has callbacks queued from this update.
+        self.evict_devices()
+
         # Need to check for new inactive devices and flag
-        for dev_id in self._devices:
-            if dev_id not in active_devices:
-                # Device no longer active
-                if self._devices[dev_id].is_active:
-                    self._devices[dev_id].set_active(False)
-                    self._do_update_callback(dev_id)
-                    self._do_stale_devices_callback(dev_id)
+        now = time.monotonic()
+        for dev_id in self._active_devices - active_devices:
+            # Device no longer active
+            self._devices[dev_id].set_active(False)
+            self._inactive_since[dev_id] = now
+            self._index_device(dev_id)
+            self._do_update_callback(dev_id)
+            self._do_stale_devices_callback(dev_id)
+        self._active_devices = active_devices
 
         # Call device callback if new devices were found.
-        if new_devices:
+        if new_devices and not announced:
             self._do_new_devices_callback(0)
 
+        if self._shm_table is not None:
+            self._shm_table.update(self._devices)
+
+    def evict_devices(self):
+        """ Remove inactive devices past their TTL or over the size limit.
+
+        Active devices are never evicted.  Returns evicted device names.
+        """
+        evicted = []
+        now = time.monotonic()
+        for dev_id, since in self._inactive_since.items():
+            expired = self._device_ttl is not None and \
+                now - since >= self._device_ttl
+            oversize = self._max_devices is not None and \
+                len(self._devices) - len(evicted) > self._max_devices
+            if not expired and not oversize:
+                # Everything after this went inactive more recently
+                break
+            evicted.append(dev_id)
+
+        for dev_id in evicted:
+            self._remove_device(dev_id)
+        return evicted
+
+    def _remove_device(self, dev_id):
+        """ Drop a device from the registry. """
+        _LOGGER.debug('Evicting inactive Emby device: %s', dev_id)
+        del self._devices[dev_id]
+        del self._inactive_since[dev_id]
+        self._unindex_device(dev_id)
+
+        # Drop update callbacks so churned devices don't pile them up
+        removed = [callback for callback, device in self._update_callbacks
+                   if device == dev_id]
+        if removed:
+            self._update_callbacks = [
+                [callback, device]
+                for callback, device in self._update_callbacks
+                if device != dev_id]
+            for callback in removed:
+                self._forget_callback(callback)
+        if self._shm_table is not None:
+            self._shm_table.remove(dev_id)
+        self._do_evicted_devices_callback(dev_id)
+
+    def find_devices(self, state=None, user=None, client=None, item_id=None):
+        """ Return devices matching all given fields using the indexes.
+
+        user matches UserName and item_id matches the now playing item.
+        """
+        query = {'state': state, 'user': user, 'client': client,
+                 'item_id': item_id}
+        matches = []
+        for field, value in query.items():
+            if value is None:
+                continue
+            matches.append(self._indexes[field].get(value, ()))
+
+        if not matches:
+            return list(self._devices.values())
+
+        # Walk the smallest set and check membership in the others
+        matches.sort(key=len)
+        smallest, others = matches[0], matches[1:]
+        return [self._devices[dev_name] for dev_name in smallest
+                if all(dev_name in other for other in others)]
+
+    def _index_device(self, dev_name):
+        """ Bring index entries for a device up to date. """
+        device = self._devices[dev_name]
+        keys = (device.state, device.username, device.client,
+                device.media_id if device.is_active else None)
+        old_keys = self._index_keys.get(dev_name)
+        if keys == old_keys:
+            return
+
+        for position, field in enumerate(INDEX_FIELDS):
+            if old_keys is not None and old_keys[position] == keys[position]:
+                continue
+            index = self._indexes[field]
+            if old_keys is not None:
+                self._discard_index(index, old_keys[position], dev_name)
+            if keys[position] is not None:
+                index.setdefault(keys[position], set()).add(dev_name)
+        self._index_keys[dev_name] = keys
+
+    def _unindex_device(self, dev_name):
+        """ Remove a device from all indexes. """
+        old_keys = self._index_keys.pop(dev_name, None)
+        if old_keys is None:
+            return
+        for position, field in enumerate(INDEX_FIELDS):
+            self._discard_index(
+                self._indexes[field], old_keys[position], dev_name)
+
+    @staticmethod
+    def _discard_index(index, value, dev_name):
+        """ Remove a device name from one index entry. """
+        entry = index.get(value)
+        if entry is not None:
+            entry.discard(dev_name)
+            if not entry:
+                del index[value]
+
     def update_check(self, existing, new):
         """ Check device state to see if we need to fire the callback.
 
@@ -453,8 +1195,97 @@ class EmbyServer(object):
                   'Limit': limit,
                   'IsPlayed': is_played}
 
-        items = await self.api_request(url, params)
+        items = await self.api_request(url, params, PRIORITY_BULK)
         if items is None:
             _LOGGER.debug('Unable to fetch items.')
         else:
             return items
+
+    async def async_get_item(self, item_id):
+        """ Return item metadata, batched with other pending lookups.
+
+        The item_fields and item_user_id server options decide which
+        fields Emby includes.  Returns None if the item can't be fetched.
+        """
+        item_id = str(item_id)
+        if item_id in self._item_cache:
+            self._item_cache.move_to_end(item_id)
+            return self._item_cache[item_id]
+
+        future = self._item_requests.get(item_id)
+        if future is None:
+            future = self._event_loop.create_future()
+            self._item_requests[item_id] = future
+            if self._item_flush is None:
+                self._item_flush = self._event_loop.call_later(
+                    ITEM_BATCH_WINDOW, self._flush_item_requests)
+
+        # Shield so one cancelled caller doesn't fail the shared lookup
+        return await asyncio.shield(future)
+
+    async def async_get_items(self, item_ids):
+        """ Return dictionary of item metadata keyed by item id. """
+        item_ids = [str(item_id) for item_id in item_ids]
+        results = await asyncio.gather(
+            *[self.async_get_item(item_id) for item_id in item_ids])
+        return dict(zip(item_ids, results))
+
+    def clear_item_cache(self):
+        """ Drop all cached item metadata. """
+        self._item_cache.clear()
+
+    def _flush_item_requests(self):
+        """ Send all item lookups gathered during the batch window. """
+        pending = self._item_requests
+        self._item_requests = {}
+        self._item_flush = None
+        asyncio.ensure_future(
+            self._async_load_items(pending), loop=self._event_loop)
+
+    async def _async_load_items(self, pending):
+        """ Resolve pending item lookups with as few requests as possible. """
+        url = '{}/Items'.format(self.construct_url(API_URL))
+        item_ids = list(pending)
+
+        try:
+            for start in range(0, len(item_ids), ITEM_BATCH_SIZE):
+                batch = item_ids[start:start + ITEM_BATCH_SIZE]
+                params = {'api_key': self._api_key,
+                          'Ids': ','.join(batch)}
+                if self._item_fields:
+                    params['Fields'] = ','.join(self._item_fields)
+                if self._item_user_id is not None:
+                    params['UserId'] = self._item_user_id
+
+                _LOGGER.debug('Fetching %s Emby items in one request.',
+                              len(batch))
+                found = {}
+                try:
+                    items = await self.api_request(url, params, PRIORITY_BULK)
+                    if items is not None:
+                        for item in items.get('Items', []):
+                            if 'Id' in item:
+                                found[item['Id']] = clean_none_dict_values(
+                                    item)
+                except Exception as err:  # pylint: disable=broad-except
+                    _LOGGER.error('Error fetching Emby items: %s', err)
+
+                for item_id, item in found.items():
+                    self._cache_item(item_id, item)
+
+                for item_id in batch:
+                    future = pending[item_id]
+                    if not future.done():
+                        future.set_result(found.get(item_id))
+        finally:
+            # Never leave a caller waiting, even if we were cancelled
+            for future in pending.values():
+                if not future.done():
+                    future.set_result(None)
+
+    def _cache_item(self, item_id, item):
+        """ Add item to the cache, dropping the least recently used. """
+        self._item_cache[item_id] = item
+        self._item_cache.move_to_end(item_id)
+        while len(self._item_cache) > ITEM_CACHE_SIZE:
+            self._item_cache.popitem(last=False)
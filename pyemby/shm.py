@@ -0,0 +1,262 @@
+"""
+pyemby.shm
+~~~~~~~~~~~~~~~~~~~~
+Shared memory now playing table for multi-process consumers.
+Copyright (c) 2017-2024 John Mihalic <https://github.com/mezz64>
+Licensed under the MIT license.
+
+Layout (little endian):
+  header: magic, layout version, capacity, row count, table sequence
+  rows:   row sequence, device id, client, flags, state, item id,
+          position ticks, runtime ticks
+
+Each row is guarded by its own sequence number.  The writer makes it odd
+before changing the row and even again afterwards, so readers can copy a
+row without locks and retry if the sequence was odd or moved.
+
+Text fields that do not fit are cut on a character boundary and the row
+is flagged as truncated.
+"""
+
+import logging
+import os
+import struct
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    resource_tracker = None
+    shared_memory = None
+
+from pyemby.constants import (
+    SHM_MAGIC, SHM_LAYOUT_VERSION, SHM_CAPACITY, SHM_STATE_CODES, STATE_OFF,
+    SHM_READ_RETRIES)
+
+_LOGGER = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<4sHIIQ')
+DEVICE_ID_SIZE = 128
+CLIENT_SIZE = 64
+ITEM_ID_SIZE = 64
+ROW = struct.Struct('<Q{}s{}sBB{}sqq'.format(
+    DEVICE_ID_SIZE, CLIENT_SIZE, ITEM_ID_SIZE))
+
+ROW_TRUNCATED = 0x01
+
+SHM_STATES = {code: state for state, code in SHM_STATE_CODES.items()}
+
+
+class NowPlayingTable(object):
+    """ Fixed layout now playing table in shared memory. """
+    def __init__(self, name, capacity=SHM_CAPACITY, create=False):
+        """Create (writer) or attach to (reader) a named table."""
+        if shared_memory is None:
+            raise RuntimeError('Shared memory requires Python 3.8 or greater.')
+
+        self._writer = create
+        if create:
+            self._shm = _create_segment(
+                name, HEADER.size + capacity * ROW.size)
+            self._capacity = capacity
+            self._count = 0
+            self._seq = 0
+            self._slots = {}
+            self._rows = {}
+            self._free = []
+            self._write_header()
+        else:
+            try:
+                # Keep the resource tracker from unlinking on reader exit
+                self._shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                # Before Python 3.13 readers are always tracked
+                self._shm = shared_memory.SharedMemory(name=name)
+                if os.name == 'posix':
+                    resource_tracker.unregister(
+                        self._shm._name, 'shared_memory')
+            magic, version, self._capacity, _, _ = HEADER.unpack_from(
+                self._shm.buf, 0)
+            if magic != SHM_MAGIC or version != SHM_LAYOUT_VERSION:
+                self._shm.close()
+                raise ValueError(
+                    'Unsupported now playing table {}'.format(name))
+
+    @property
+    def name(self):
+        """ Return shared memory block name. """
+        return self._shm.name
+
+    @property
+    def capacity(self):
+        """ Return maximum number of rows. """
+        return self._capacity
+
+    @property
+    def sequence(self):
+        """ Return table sequence, bumped after every batch of writes. """
+        return HEADER.unpack_from(self._shm.buf, 0)[4]
+
+    def update(self, devices):
+        """ Write changed devices from a server device dictionary. """
+        changed = False
+        for dev_name, device in devices.items():
+            session = device.session_raw
+            item = session.get('NowPlayingItem', {})
+            item_id = item.get('Id', '')
+            runtime = int(item.get('RunTimeTicks', 0))
+            position = int(
+                session.get('PlayState', {}).get('PositionTicks', 0))
+
+            row = (device.unique_id or '', device.client or '',
+                   SHM_STATE_CODES[device.state], item_id, position, runtime)
+            if self._rows.get(dev_name) == row:
+                continue
+
+            slot = self._slots.get(dev_name)
+            if slot is None:
+                if self._free:
+                    slot = self._free.pop()
+                elif self._count < self._capacity:
+                    slot = self._count
+                    self._count += 1
+                else:
+                    _LOGGER.debug('Now playing table full, skipping %s',
+                                  dev_name)
+                    continue
+                self._slots[dev_name] = slot
+
+            if self._write_row(slot, row):
+                _LOGGER.debug('Now playing row for %s was truncated',
+                              dev_name)
+            self._rows[dev_name] = row
+            changed = True
+
+        if changed:
+            self._seq += 1
+            self._write_header()
+
+    def remove(self, dev_name):
+        """ Clear the row of a device and free its slot. """
+        slot = self._slots.pop(dev_name, None)
+        if slot is None:
+            return
+        del self._rows[dev_name]
+        self._write_row(slot, ('', '', SHM_STATE_CODES[STATE_OFF], '', 0, 0))
+        self._free.append(slot)
+        self._seq += 1
+        self._write_header()
+
+    def read(self):
+        """ Return a consistent copy of every row. """
+        count = HEADER.unpack_from(self._shm.buf, 0)[3]
+        return [row for row in (self.read_row(slot) for slot in range(count))
+                if row is not None]
+
+    def read_row(self, slot):
+        """ Return a consistent copy of one row, None if unused.
+
+        Also None if the row could not be read consistently, which only
+        happens if the writer stopped part way through an update.
+        """
+        offset = HEADER.size + slot * ROW.size
+        for _ in range(SHM_READ_RETRIES):
+            values = ROW.unpack_from(self._shm.buf, offset)
+            if values[0] % 2:
+                # Writer is mid-update
+                continue
+            if ROW.unpack_from(self._shm.buf, offset)[0] == values[0]:
+                break
+        else:
+            _LOGGER.debug('Gave up reading now playing row %s', slot)
+            return None
+
+        (seq, device_id, client, flags, state, item_id,
+         position, runtime) = values
+        device_id = _decode(device_id)
+        if not seq or not device_id:
+            # Never written, or freed by remove()
+            return None
+        client = _decode(client)
+        return {
+            'device': '{}.{}'.format(device_id, client),
+            'device_id': device_id,
+            'client': client,
+            'state': SHM_STATES.get(state),
+            'item_id': _decode(item_id),
+            'position': position / 10000000,
+            'runtime': runtime / 10000000,
+            'truncated': bool(flags & ROW_TRUNCATED),
+            'sequence': seq,
+        }
+
+    def close(self):
+        """ Detach from the table, removing it if we are the writer. """
+        self._shm.close()
+        if self._writer:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                _LOGGER.debug('Now playing table %s already removed',
+                              self._shm.name)
+
+    def _write_header(self):
+        """ Write table header. """
+        HEADER.pack_into(self._shm.buf, 0, SHM_MAGIC, SHM_LAYOUT_VERSION,
+                         self._capacity, self._count, self._seq)
+
+    def _write_row(self, slot, row):
+        """ Write one row guarded by its sequence number.
+
+        Returns true if any text field had to be truncated.
+        """
+        device_id, client, state, item_id, position, runtime = row
+        device_id, cut_device = _encode(device_id, DEVICE_ID_SIZE)
+        client, cut_client = _encode(client, CLIENT_SIZE)
+        item_id, cut_item = _encode(item_id, ITEM_ID_SIZE)
+        truncated = cut_device or cut_client or cut_item
+        flags = ROW_TRUNCATED if truncated else 0
+
+        offset = HEADER.size + slot * ROW.size
+        seq = ROW.unpack_from(self._shm.buf, offset)[0]
+        struct.pack_into('<Q', self._shm.buf, offset, seq + 1)
+
+        ROW.pack_into(self._shm.buf, offset, seq + 1, device_id, client,
+                      flags, state, item_id, position, runtime)
+
+        struct.pack_into('<Q', self._shm.buf, offset, seq + 2)
+        return truncated
+
+
+def _create_segment(name, size):
+    """ Create a zeroed segment, taking over one left by an unclean exit. """
+    try:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+        pass
+
+    shm = shared_memory.SharedMemory(name=name)
+    magic, version = HEADER.unpack_from(shm.buf, 0)[:2]
+    if magic == SHM_MAGIC and version == SHM_LAYOUT_VERSION and \
+            shm.size >= size:
+        # Reuse it in place so readers that are still attached carry on
+        _LOGGER.debug('Reusing existing now playing table %s', name)
+        shm.buf[:size] = bytes(size)
+        return shm
+
+    _LOGGER.debug('Replacing incompatible shared memory segment %s', name)
+    shm.close()
+    shm.unlink()
+    return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+
+def _encode(value, size):
+    """ Encode text to fit size bytes without splitting a character. """
+    raw = value.encode('utf-8')
+    if len(raw) <= size:
+        return raw, False
+    return raw[:size].decode('utf-8', 'ignore').encode('utf-8'), True
+
+
+def _decode(raw):
+    """ Decode a null padded text field. """
+    return raw.rstrip(b'\0').decode('utf-8', 'replace')
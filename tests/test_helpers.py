@@ -0,0 +1,53 @@
+"""Tests for pyemby.helpers."""
+import asyncio
+import time
+
+from pyemby.helpers import TimedCoroutine
+
+
+def run(coro):
+    """Run a coroutine on a fresh event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_timed_coroutine_measures_blocking_step():
+    """Synchronous work before the first await is measured."""
+    async def callback():
+        time.sleep(0.05)
+        await asyncio.sleep(0.1)
+        return 'done'
+
+    async def scenario():
+        timed = TimedCoroutine(callback())
+        result = await asyncio.wait_for(timed, 1)
+        return result, timed.max_step
+
+    result, max_step = run(scenario())
+    assert result == 'done'
+    assert 0.05 <= max_step < 0.1
+
+
+def test_timed_coroutine_timeout_cancels_wrapped():
+    """Timeouts cancel the wrapped coroutine."""
+    cancelled = []
+
+    async def callback():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def scenario():
+        try:
+            await asyncio.wait_for(TimedCoroutine(callback()), 0.05)
+        except asyncio.TimeoutError:
+            return True
+        return False
+
+    assert run(scenario())
+    assert cancelled == [True]
@@ -0,0 +1,72 @@
+"""Tests for pyemby.limiter."""
+import asyncio
+
+from pyemby.constants import PRIORITY_BULK, PRIORITY_COMMAND, PRIORITY_DEFAULT
+from pyemby.limiter import RateLimiter
+
+
+def run(coro):
+    """Run a coroutine on a fresh event loop."""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_sequential_calls_under_rate_limit():
+    """A drained bucket refills and grants the next call."""
+    async def scenario():
+        limiter = RateLimiter(asyncio.get_event_loop(), 10, 1, 10)
+        for _ in range(3):
+            await asyncio.wait_for(limiter.acquire(PRIORITY_DEFAULT), 1)
+            limiter.release()
+        return limiter.queue_wait_stats['default']
+
+    stats = run(scenario())
+    assert stats['count'] == 3
+    assert stats['queued'] == 0
+    assert stats['max'] > 0
+
+
+def test_in_flight_limit_serves_command_lane_first():
+    """Queued commands are granted before queued bulk requests."""
+    async def scenario():
+        limiter = RateLimiter(asyncio.get_event_loop(), max_in_flight=1)
+        order = []
+
+        async def request(priority, name):
+            await limiter.acquire(priority)
+            order.append(name)
+            limiter.release()
+
+        await limiter.acquire(PRIORITY_DEFAULT)
+        tasks = [asyncio.ensure_future(request(PRIORITY_BULK, 'bulk')),
+                 asyncio.ensure_future(request(PRIORITY_COMMAND, 'command'))]
+        await asyncio.sleep(0)
+        assert limiter.in_flight == 1
+        limiter.release()
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        return order
+
+    assert run(scenario()) == ['command', 'bulk']
+
+
+def test_command_lane_not_blocked_by_bulk():
+    """Bulk requests can't take the slot held back for commands."""
+    async def scenario():
+        limiter = RateLimiter(asyncio.get_event_loop(), max_in_flight=2)
+        await limiter.acquire(PRIORITY_BULK)
+        bulk = asyncio.ensure_future(limiter.acquire(PRIORITY_BULK))
+        await asyncio.sleep(0)
+        assert not bulk.done()
+
+        await asyncio.wait_for(limiter.acquire(PRIORITY_COMMAND), 0.1)
+        assert limiter.in_flight == 2
+
+        limiter.release()
+        limiter.release()
+        await asyncio.wait_for(bulk, 1)
+        return limiter.in_flight
+
+    assert run(scenario()) == 1
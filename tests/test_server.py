@@ -0,0 +1,57 @@
+"""Tests for pyemby.server."""
+import asyncio
+
+from pyemby.server import EmbyServer
+
+
+def make_session(device_id, client='Web'):
+    """Return a minimal idle session."""
+    return {'DeviceId': device_id, 'Client': client, 'Id': device_id}
+
+
+def test_eviction_waits_for_stale_callbacks():
+    """Devices are still registered when their stale callbacks run."""
+    loop = asyncio.new_event_loop()
+    server = EmbyServer('localhost', 'key', loop=loop, max_devices=1)
+    events = []
+
+    def on_update(msg):
+        events.append(('update', msg, msg in server.devices))
+
+    def on_stale(msg):
+        events.append(('stale', msg, msg in server.devices))
+
+    def on_evicted(msg):
+        events.append(('evicted', msg, msg in server.devices))
+
+    server.add_stale_devices_callback(on_stale)
+    server.add_evicted_devices_callback(on_evicted)
+
+    server.update_device_list([make_session('x'), make_session('y')])
+    server.add_update_callback(on_update, 'x.Web')
+
+    server.update_device_list([make_session('y')])
+    loop.run_until_complete(asyncio.sleep(0))
+    assert events == [('update', 'x.Web', True), ('stale', 'x.Web', True)]
+    assert 'x.Web' in server.devices
+
+    server.update_device_list([make_session('y')])
+    loop.run_until_complete(asyncio.sleep(0))
+    assert events[-1] == ('evicted', 'x.Web', False)
+    assert list(server.devices) == ['y.Web']
+    loop.close()
+
+
+def test_eviction_by_ttl_keeps_active_devices():
+    """Only inactive devices past the TTL are evicted."""
+    loop = asyncio.new_event_loop()
+    server = EmbyServer('localhost', 'key', loop=loop, device_ttl=0)
+
+    server.update_device_list([make_session('x'), make_session('y')])
+    server.update_device_list([make_session('y')])
+    assert sorted(server.devices) == ['x.Web', 'y.Web']
+
+    server.update_device_list([make_session('y')])
+    assert list(server.devices) == ['y.Web']
+    assert server.find_devices(client='Web') == [server.devices['y.Web']]
+    loop.close()
@@ -0,0 +1,68 @@
+"""Tests for pyemby.shm."""
+import uuid
+
+from pyemby.device import EmbyDevice
+from pyemby.shm import NowPlayingTable
+
+
+def make_device(device_id, client='Emby Web'):
+    """Return a playing device."""
+    return EmbyDevice({
+        'DeviceId': device_id, 'Client': client,
+        'NowPlayingItem': {'Id': '42', 'RunTimeTicks': 600000000},
+        'PlayState': {'IsPaused': False, 'PositionTicks': 100000000},
+    }, None)
+
+
+def test_reader_sees_rows_and_truncation():
+    """Rows round trip and oversized device ids are flagged."""
+    name = 'pyemby_{}'.format(uuid.uuid4().hex[:12])
+    writer = NowPlayingTable(name, 4, create=True)
+    try:
+        writer.update({'a.Emby Web': make_device('a'),
+                       'long.Emby Web': make_device('é' * 100)})
+        reader = NowPlayingTable(name)
+        rows = {row['client'] + row['device_id'][:1]: row
+                for row in reader.read()}
+        reader.close()
+    finally:
+        writer.close()
+
+    short = rows['Emby Weba']
+    assert short['device'] == 'a.Emby Web'
+    assert short['state'] == 'Playing'
+    assert short['position'] == 10.0
+    assert not short['truncated']
+
+    long = rows['Emby Webé']
+    assert long['truncated']
+    assert long['device_id'] == 'é' * 64
+
+
+def test_remove_frees_row_and_close_is_idempotent():
+    """Removed rows disappear and closing twice does not raise."""
+    name = 'pyemby_{}'.format(uuid.uuid4().hex[:12])
+    writer = NowPlayingTable(name, 1, create=True)
+    writer.update({'a.c': make_device('a', 'c')})
+    writer.remove('a.c')
+    assert writer.read() == []
+    writer.update({'b.c': make_device('b', 'c')})
+    assert [row['device'] for row in writer.read()] == ['b.c']
+    writer.close()
+    writer.close()
+
+
+def test_writer_takes_over_leftover_segment():
+    """A segment left behind by a dead writer doesn't block a new one."""
+    name = 'pyemby_{}'.format(uuid.uuid4().hex[:12])
+    stale = NowPlayingTable(name, 2, create=True)
+    stale.update({'a.c': make_device('a', 'c')})
+
+    writer = NowPlayingTable(name, 2, create=True)
+    try:
+        assert writer.read() == []
+        writer.update({'b.c': make_device('b', 'c')})
+        assert [row['device'] for row in writer.read()] == ['b.c']
+    finally:
+        writer.close()
+        stale.close()